@@ -4,37 +4,56 @@ Dependencies:
   debootstrap
   mksquashfs (squashfs-tools)
   systemd-nspawn (systemd-container)
-  lz4 (liblz4-tool)
-  fdisk
+  zstd
+  dosfstools
+  mtools
+  e2fsprogs
+  fallocate (util-linux)
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from io import BytesIO
 from subprocess import PIPE
 from pathlib import Path
-from textwrap import dedent
 from textwrap import dedent as dd
 from tempfile import TemporaryDirectory
 import os
+import errno
 import hashlib
-from os import chdir
-from os import makedirs
-from glob import glob
+import re
 from os.path import abspath
-from os.path import basename
 from os.path import exists
-from shutil import copyfile
+from os.path import realpath
 from shutil import rmtree
+from shutil import which
+import struct
 import subprocess
+import tarfile
+import time
 import uuid
+import zlib
 
 GPT_ROOT_X86_64 = uuid.UUID('4f68bce3-e8cd-4db1-96e7-fbcaf984b709')
 GPT_BIOS = uuid.UUID('21686148-6449-6e6f-744e-656564454649')
+GPT_ESP = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+GPT_LINUX_DATA = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+
+GPT_HEADER = "<8sIIIIQQQQ16sQIII"
+GPT_ENTRY = "<16s16sQQQ72s"
+GPT_ENTRIES = 128
 
 SECTOR = 512
 MB = 1024 * 1024
 GB = 1024 * 1024 * 1024
 FOOTER_SECTORS = 34
 ESP_SECTORS = 409600
+ROOT_START = 2048 + ESP_SECTORS
+SQUASHFS_MAGIC = 0x73717368 # "hsqs"
+
+# Files added through the customization tarball are stamped with this, rather than
+# with TarInfo's default of the epoch
+BUILD_TIME = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
 
 SYSTEMD_CONFIG_UNIT = """\
 [Manager]
@@ -113,56 +132,121 @@ manual_add_modules overlay
 """
 
 
-def copy(in_fh, out_fh):
-    while True:
-        data = in_fh.read(SECTOR)
-        if len(data) == 0:
-            break
+def copy(in_fh, out_fh, offset, length):
+    # sendfile() moves the data inside the kernel; the output can be a pipe
+    while length > 0:
+        sent = os.sendfile(out_fh.fileno(), in_fh.fileno(), offset, length)
+        if sent == 0:
+            raise EOFError(f"{in_fh.name} ended {length} bytes early")
 
-        out_fh.write(data)
+        offset += sent
+        length -= sent
 
 
-def format_disk(esp_uuid, root_partuuid, outfile):
-    with open(outfile, "wb") as out_fh:
-        out_fh.truncate(GB)
+def data_extents(fh):
+    """Yield (start, end) for each region of fh that isn't a hole.
 
-    remaining = GB // SECTOR - (2048 + ESP_SECTORS + FOOTER_SECTORS)
-    table = [
-        "label: gpt",
-        "first-lba: 2048",
-        f'size={ESP_SECTORS}, uuid={esp_uuid}, type=c12a7328-f81f-11d2-ba4b-00a0c93ec93b, name="EFI System Partition"',
-        f'size={remaining}, uuid={root_partuuid}, type=0fc63daf-8483-4772-8e79-3d69d8477de4, name="State Partition"',
+    Regions are widened to whole MiBs, so everything in between is a whole number of
+    MiBs of zeros."""
+    size = os.fstat(fh.fileno()).st_size
+    extent = None
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fh.fileno(), offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            break  # Nothing but a hole from here on
+
+        offset = os.lseek(fh.fileno(), start, os.SEEK_HOLE)
+        start = start // MB * MB
+        end = min(-(-offset // MB) * MB, size)
+        if extent and start <= extent[1]:
+            extent = (extent[0], end)
+            continue
+
+        if extent:
+            yield extent
+        extent = (start, end)
+
+    if extent:
+        yield extent
+
+
+def protective_mbr(sectors):
+    # A single partition of type 0xEE covering the whole disk, so that MBR-only
+    # tools leave the GPT alone.
+    entry = struct.pack("<B3sB3sII", 0, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff", 1, min(sectors - 1, 0xFFFFFFFF))
+    return bytes(446) + entry + bytes(48) + b"\x55\xaa"
+
+
+def gpt_entry(type_guid, partuuid, first_lba, size, name):
+    return struct.pack(
+        GPT_ENTRY,
+        type_guid.bytes_le, uuid.UUID(partuuid).bytes_le,
+        first_lba, first_lba + size - 1, 0,
+        name.encode("utf-16-le"),
+    )
+
+
+def gpt_header(current_lba, backup_lba, entries_lba, last_usable_lba, disk_guid, entries):
+    fields = [
+        b"EFI PART", 0x00010000, struct.calcsize(GPT_HEADER), 0, 0,
+        current_lba, backup_lba, 2048, last_usable_lba,
+        disk_guid.bytes_le, entries_lba, GPT_ENTRIES, struct.calcsize(GPT_ENTRY), zlib.crc32(entries),
     ]
+    # The header CRC is computed with the CRC field itself zeroed
+    fields[3] = zlib.crc32(struct.pack(GPT_HEADER, *fields))
+    return struct.pack(GPT_HEADER, *fields).ljust(SECTOR, b"\x00")
 
-    run(["sfdisk", "--color=never", outfile], input='\n'.join(table).encode('utf-8'))
 
+def state_layout(root_sectors):
+    """Return the (start, size) in sectors of the state partition.
 
+    It takes up whatever the squashfs root partition leaves over."""
+    start = ROOT_START + root_sectors
+    size = GB // SECTOR - (start + FOOTER_SECTORS)
+    assert size * SECTOR >= 64 * MB, "squashfs leaves no room for the state partition"
+    return start, size
 
-@contextmanager
-def attach_image_loopback(filename):
-    c = run(["losetup", "--find", "--show", "--partscan", filename], stdout=PIPE)
-    loopdev = c.stdout.decode("utf-8").strip()
 
-    try:
-        yield loopdev
-    finally:
-        run(["losetup", "--detach", loopdev])
+def format_disk(esp_uuid, root_partuuid, state_partuuid, root_sectors, outfile):
+    """Write a protective MBR plus primary and backup GPTs.
+
+    The layout is simple enough that there's no point in having sfdisk parse a
+    script to produce it."""
+    sectors = GB // SECTOR
+    state_start, state_sectors = state_layout(root_sectors)
+    entries = b"".join([
+        gpt_entry(GPT_ESP, esp_uuid, 2048, ESP_SECTORS, "EFI System Partition"),
+        gpt_entry(GPT_ROOT_X86_64, root_partuuid, ROOT_START, root_sectors, "Root Partition"),
+        gpt_entry(GPT_LINUX_DATA, state_partuuid, state_start, state_sectors, "State Partition"),
+    ]).ljust(GPT_ENTRIES * struct.calcsize(GPT_ENTRY), b"\x00")
+
+    backup_lba = sectors - 1
+    backup_entries_lba = backup_lba - len(entries) // SECTOR
+    disk_guid = uuid.uuid4()
+
+    with open(outfile, "r+b") as out_fh:
+        out_fh.write(protective_mbr(sectors))
+        out_fh.write(gpt_header(1, backup_lba, 2, backup_entries_lba - 1, disk_guid, entries))
+        out_fh.write(entries)
+
+        out_fh.seek(backup_entries_lba * SECTOR)
+        out_fh.write(entries)
+        out_fh.write(gpt_header(backup_lba, 1, backup_entries_lba, backup_entries_lba - 1, disk_guid, entries))
 
 
 def run(*args, **kwargs):
     kwargs.setdefault("check", True)
     return subprocess.run(*args, **kwargs)
 
-@contextmanager
-def mountedcwd(device):
-    with TemporaryDirectory(dir=".") as mountpoint:
-        run(["mount", device, mountpoint])
-        chdir(mountpoint)
-        try:
-            yield
-        finally:
-            chdir("..")
-            run(["umount", mountpoint])
+def mtools(*args, **kwargs):
+    # mtools refuses to work with filesystems whose geometry doesn't divide evenly
+    # into cylinders, which is meaningless for a disk image.
+    kwargs.setdefault("env", {**os.environ, "MTOOLS_SKIP_CHECK": "1"})
+    return run(*args, **kwargs)
 
 def hash_pe_coff(fh):
     hasher = hashlib.sha256()
@@ -172,128 +256,247 @@ def hash_pe_coff(fh):
     fh.read(4) # Skip the checksum
     hasher.update(fh.read(76))
     assert fh.read(8) == b"\x00" * 8 # Security directory is empty
-    while buf := fh.read(4096):
+    # file_digest() feeds the rest of the file to our hasher in large chunks. It's
+    # new in Python 3.11, and jammy ships 3.10.
+    if hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(fh, lambda: hasher).hexdigest()
+    while buf := fh.read(MB):
         hasher.update(buf)
-
     return hasher.hexdigest()
 
-def set_up_boot(raw_image, root_partuuid, esp_uuid):
+def build_efi(root_partuuid):
     Path("boot/os-release").write_text('NAME="Ubuntu 22.04"')
-    Path("boot/cmdline").write_text(f"root=PARTUUID={root_partuuid} loop=root.squashfs debug console=ttyS0")
-    run(["objcopy",
-        "--add-section", ".osrel=boot/os-release", "--change-section-vma", ".osrel=0x20000",
-        "--add-section", ".cmdline=boot/cmdline", "--change-section-vma", ".cmdline=0x30000",
-        "--add-section", ".linux=boot/vmlinuz", "--change-section-vma", ".linux=0x2000000",
-        "--add-section", ".initrd=boot/initrd.img", "--change-section-vma", ".initrd=0x3000000",
-        "/usr/lib/systemd/boot/efi/linuxx64.efi.stub",
-        "boot/ubuntu.efi",
-    ])
+    Path("boot/cmdline").write_text(f"root=PARTUUID={root_partuuid} rootfstype=squashfs debug console=ttyS0")
+    # ukify (systemd 254+) lays the sections out itself. objcopy needs hardcoded
+    # addresses, which fall over once the kernel outgrows its 16 MiB slot.
+    if which("ukify"):
+        run(["ukify", "build",
+            "--linux=boot/vmlinuz",
+            "--initrd=boot/initrd.img",
+            "--cmdline=@boot/cmdline",
+            "--os-release=@boot/os-release",
+            "--output=boot/ubuntu.efi",
+        ])
+    else:
+        run(["objcopy",
+            "--add-section", ".osrel=boot/os-release", "--change-section-vma", ".osrel=0x20000",
+            "--add-section", ".cmdline=boot/cmdline", "--change-section-vma", ".cmdline=0x30000",
+            "--add-section", ".linux=boot/vmlinuz", "--change-section-vma", ".linux=0x2000000",
+            "--add-section", ".initrd=boot/initrd.img", "--change-section-vma", ".initrd=0x3000000",
+            "/usr/lib/systemd/boot/efi/linuxx64.efi.stub",
+            "boot/ubuntu.efi",
+        ])
+
+    # This is the Authenticode digest that firmware measures into PCR 4. ukify's
+    # --measure only predicts PCR 11, so we still compute it ourselves.
     with open("boot/ubuntu.efi", "rb") as fh:
         digest = hash_pe_coff(fh)
     print(f"Expected TPM binary hash: {digest}")
 
-    with attach_image_loopback(raw_image) as loopdev:
-        run(["mkfs.vfat", f"{loopdev}p1"])
-        with mountedcwd(f"{loopdev}p1"):
-            makedirs("EFI/boot")
-            copyfile("../boot/ubuntu.efi", "EFI/boot/bootx64.efi")
 
-        run(["mkfs.ext4", f"{loopdev}p2"])
-        with mountedcwd(f"{loopdev}p2"):
-            copyfile("../image.squashfs", "root.squashfs")
+def set_up_boot(raw_image):
+    # Every partition is written straight into its slot in the raw image, so there's
+    # no need for a loop device or any mounts. The ESP goes in here; mksquashfs and
+    # set_up_state() take care of the others.
+    run(["mkfs.vfat", "--offset", "2048", raw_image, str(ESP_SECTORS * SECTOR // 1024)])
 
+    # Lay the ESP out as a directory tree so that one recursive mcopy fills it in
+    if exists("esp"):
+        rmtree("esp")
+    os.makedirs("esp/EFI/boot")
+    os.link("boot/ubuntu.efi", "esp/EFI/boot/bootx64.efi")
+    mtools(["mcopy", "-s", "-i", f"{raw_image}@@{2048 * SECTOR}", "esp/EFI", "::"])
 
-def rm_f(filename):
-    try:
-        os.remove(filename)
-    except FileNotFoundError:
-        pass
 
+def root_partition_sectors(raw_image):
+    """Return the size in sectors of the squashfs that mksquashfs wrote in place.
+
+    The partition is the squashfs itself, padded out to a whole MiB. The raw image
+    is extended to its full size on the way out."""
+    with open(raw_image, "r+b") as fh:
+        fh.seek(ROOT_START * SECTOR)
+        # bytes_used sits 40 bytes into the squashfs superblock
+        magic, size = struct.unpack("<I36xQ", fh.read(48))
+        assert magic == SQUASHFS_MAGIC
+        # mksquashfs leaves the file ending wherever the filesystem does
+        fh.truncate(GB)
+
+    return -(-size // MB) * MB // SECTOR
+
+
+def set_up_state(raw_image, root_sectors):
+    start, size = state_layout(root_sectors)
+    run([
+        "mkfs.ext4",
+        "-E", f"offset={start * SECTOR}",
+        raw_image, f"{size * SECTOR // 1024}k",
+    ])
 
-def compress_product(outfile):
+
+def compress_product(raw_image, outfile):
     """Compress the final product.
 
     Since the expectation is that this will get uploaded to S3, which doesn't have
-    any mechanism for sparse encoding or transfer, we'll just use LZ4 to wring the zero
-    regions out of the finished file."""
-    rm_f(f"{outfile}.lz4")
-    run(["lz4", outfile])
+    any mechanism for sparse encoding or transfer, we'll just use zstd to wring the
+    zero regions out of the finished file.
+
+    The compressor only ever sees the regions of the image that contain data. zstd
+    frames can be concatenated, so the holes in between are filled in with copies of
+    a frame holding one MiB of zeros."""
+    # mkfs writes out plenty of blocks that are nothing but zeros (inode tables, empty
+    # FATs). Turn those back into holes so the compressor doesn't get to see them.
+    run(["fallocate", "--dig-holes", raw_image])
+
+    args = ["zstd", "-3", "-T0", "--long=27", "-q", "-c"]
+    zeros = run(args, input=bytes(MB), stdout=PIPE).stdout
+    with open(raw_image, "rb") as in_fh, open(outfile, "wb") as out_fh:
+        size = os.fstat(in_fh.fileno()).st_size
+        assert size % MB == 0
 
+        position = 0
+        for start, end in data_extents(in_fh):
+            out_fh.write(zeros * ((start - position) // MB))
+            out_fh.flush()
 
-def change_passwords(image):
-    new_lines = []
-    with open(image + "/etc/shadow", "r+") as shadow:
-        for entry in shadow:
-            fields = entry.split(":")
-            if fields[0] == "root":
-                fields[1] = ""
+            with subprocess.Popen(args, stdin=PIPE, stdout=out_fh) as compressor:
+                copy(in_fh, compressor.stdin, start, end - start)
+                compressor.stdin.close()
+            if compressor.returncode != 0:
+                raise subprocess.CalledProcessError(compressor.returncode, args)
 
-            new_lines.append(':'.join(fields))
+            position = end
 
-        shadow.seek(0)
-        shadow.truncate()
-        for line in new_lines:
-            shadow.write(line)
+        out_fh.write(zeros * ((size - position) // MB))
 
 
-def mask_service(name):
-    Path(f"image/etc/systemd/system/{name}.service").symlink_to("/dev/null")
+def change_passwords(tar, image):
+    # Take ownership and mode from the existing file; /etc/shadow isn't world-readable
+    info = tar.gettarinfo(image + "/etc/shadow", "etc/shadow")
+    data, found = re.subn(rb"^root:[^:]*:", b"root::", Path(image + "/etc/shadow").read_bytes(), count=1, flags=re.M)
+    assert found == 1, "no root entry in /etc/shadow"
+    info.size = len(data)
+    tar.addfile(info, BytesIO(data))
 
-def make_unit(name, contents, *, symlink="multi-user.target.wants"):
-    units = "image/etc/systemd/system/"
-    unit_file = Path(f"{units}/{name}")
 
-    unit_file.write_text(contents)
+@contextmanager
+def overlay(root):
+    """Unpack everything added to the yielded tarball over root in one go.
+
+    Customizations touch dozens of small files, directories and symlinks. Streaming
+    them through tar lets it create them as a single sequential stream, and the
+    archive never has to be held in memory."""
+    # Owners are recorded by number; the builder's names may map to different ids
+    args = ["tar", "-x", "--numeric-owner", "-C", root]
+    with subprocess.Popen(args, stdin=PIPE) as extract:
+        with tarfile.open(fileobj=extract.stdin, mode="w|") as tar:
+            yield tar
+        extract.stdin.close()
+    if extract.returncode != 0:
+        raise subprocess.CalledProcessError(extract.returncode, args)
+
+@contextmanager
+def tmpfs(path, size):
+    """Mount a tmpfs on path, and unmount it again once the build is done with it."""
+    os.makedirs(path, exist_ok=True)
+    run(["mount", "-t", "tmpfs", "-o", f"size={size},mode=0755", "tmpfs", path])
+    cwd = os.getcwd()
+    try:
+        yield
+    finally:
+        # The build may have chdir'd into the mount, which would keep it busy
+        os.chdir(cwd)
+        run(["umount", path])
+
+def add_file(tar, name, contents, mode=0o644):
+    data = contents.encode("utf-8")
+    info = tarfile.TarInfo(name)
+    info.mtime = BUILD_TIME
+    info.size = len(data)
+    info.mode = mode
+    tar.addfile(info, BytesIO(data))
+
+def add_dir(tar, name, mode=0o755):
+    info = tarfile.TarInfo(name)
+    info.mtime = BUILD_TIME
+    info.type = tarfile.DIRTYPE
+    info.mode = mode
+    tar.addfile(info)
+
+def add_symlink(tar, name, target):
+    info = tarfile.TarInfo(name)
+    info.mtime = BUILD_TIME
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    tar.addfile(info)
+
+
+def mask_service(tar, name):
+    add_symlink(tar, f"etc/systemd/system/{name}.service", "/dev/null")
+
+def make_unit(tar, name, contents, *, symlink="multi-user.target.wants"):
+    units = "etc/systemd/system"
+
+    add_file(tar, f"{units}/{name}", contents)
     if symlink:
-        Path(f"{units}/{symlink}/{name}").symlink_to(unit_file)
+        add_symlink(tar, f"{units}/{symlink}/{name}", f"/{units}/{name}")
 
 
-def customize_image():
-    Path("image/etc/systemd/network/ena.network").write_text(ENA_UNIT)
-    Path("image/etc/systemd/system/multi-user.target.wants/systemd-networkd.service").symlink_to("/lib/systemd/system/systemd-networkd.service")
-    Path("image/efi").mkdir()
-    Path("image/root/.ssh").mkdir()
-    Path("image/root/.ssh/authorized_keys").write_text("ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKr4DFWVEoLCTgjtzl3wT+JnYnDojJAS/4hsFww4n/R8\n")
+def customize_image(tar):
+    add_file(tar, "etc/systemd/network/ena.network", ENA_UNIT)
+    add_symlink(tar, "etc/systemd/system/multi-user.target.wants/systemd-networkd.service", "/lib/systemd/system/systemd-networkd.service")
+    add_dir(tar, "efi")
+    add_dir(tar, "root/.ssh")
+    add_file(tar, "root/.ssh/authorized_keys", "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKr4DFWVEoLCTgjtzl3wT+JnYnDojJAS/4hsFww4n/R8\n")
 
-    for key in glob("image/etc/ssh/ssh_host_*_key"):
-        filename = basename(key)
-        os.remove(key)
-        os.symlink("/var/lib/ssh/" + filename, key)
+    with os.scandir("image/etc/ssh") as entries:
+        for entry in entries:
+            if not entry.name.startswith("ssh_host_"):
+                continue
 
-    for key in glob("image/etc/ssh/ssh_host_*_key.pub"):
-        os.remove(key)
+            if entry.name.endswith("_key"):
+                os.remove(entry.path)
+                add_symlink(tar, f"etc/ssh/{entry.name}", "/var/lib/ssh/" + entry.name)
+            elif entry.name.endswith("_key.pub"):
+                os.remove(entry.path)
 
-    Path("image/etc/fstab").write_text("none /tmp tmpfs defaults 0 0\n")
+    add_file(tar, "etc/fstab", "none /tmp tmpfs defaults 0 0\n")
 
-    units = "image/etc/systemd/system"
+    units = "etc/systemd/system"
 
-    Path(f"{units}.conf").write_text(SYSTEMD_CONFIG_UNIT)
-    Path(f"{units}/ssh-keygen.service").write_text(SSH_KEYGEN_UNIT)
-    Path(f"{units}/ssh-keygen.service").write_text(SSH_KEYGEN_UNIT)
-    Path(f"{units}/ssh.service.requires").mkdir()
-    Path(f"{units}/ssh.service.requires/ssh-keygen.service").symlink_to("/etc/systemd/system/ssh-keygen.service")
+    add_file(tar, f"{units}.conf", SYSTEMD_CONFIG_UNIT)
+    add_file(tar, f"{units}/ssh-keygen.service", SSH_KEYGEN_UNIT)
+    add_dir(tar, f"{units}/ssh.service.requires")
+    add_symlink(tar, f"{units}/ssh.service.requires/ssh-keygen.service", "/etc/systemd/system/ssh-keygen.service")
 
-    make_unit("imds.service", IMDS_UNIT)
-    make_unit("hostname.service", HOSTNAME_UNIT)
-    mask_service("e2scrub_reap")
+    make_unit(tar, "imds.service", IMDS_UNIT)
+    make_unit(tar, "hostname.service", HOSTNAME_UNIT)
+    mask_service(tar, "e2scrub_reap")
 
 def print_sha256(filename):
     blob = Path(filename).read_bytes()
     digest = hashlib.sha256(blob).hexdigest()
     print(f"sha256({repr(filename)}): {digest}")
 
-def extract_kernel():
+def extract_kernel(apt_cache):
+    # Share mkosi's package cache so the kernel .debs are only downloaded once. The
+    # lists are left alone: they came from mkosi and apt-get needs them to install.
     run([
         "systemd-nspawn",
         "-D", "image", "--resolv-conf=bind-host",
-        "apt-get", "install", "-y", "--no-install-recommends", "linux-image-aws",
+        f"--bind={apt_cache}:/var/cache/apt/archives",
+        "apt-get", "install", "-y", "--no-install-recommends",
+        # Don't bother writing out the binary package caches, they're deleted below
+        "-o", "Dir::Cache::pkgcache=", "-o", "Dir::Cache::srcpkgcache=",
+        "linux-image-aws",
     ])
 
     if exists("boot"):
         rmtree("boot")
     os.mkdir("boot")
-    copyfile("image/boot/vmlinuz", "boot/vmlinuz")
-    copyfile("image/boot/initrd.img", "boot/initrd.img")
+    # These are symlinks to the versioned files; move the targets, which is just a
+    # rename since they're on the same filesystem.
+    os.replace(realpath("image/boot/vmlinuz"), "boot/vmlinuz")
+    os.replace(realpath("image/boot/initrd.img"), "boot/initrd.img")
     rmtree("image/boot")
 
     # apt lists are huge. They aren't costly at runtime (because they don't get 
@@ -303,28 +506,29 @@ def extract_kernel():
     rmtree("image/var/lib/apt/lists")
 
 
-def make_squashfs(squashfs_image):
-    rm_f(squashfs_image)
+def make_squashfs(raw_image):
     run([
-        "mksquashfs", "image", squashfs_image,
-        "-comp", "zstd", "-processors", "1",
+        "mksquashfs", "image", raw_image,
+        # Write the filesystem straight into the root partition's slot. It can't go
+        # through a pipe instead: mksquashfs seeks back to write its superblock last.
+        "-noappend", "-offset", str(ROOT_START * SECTOR),
+        "-processors", str(len(os.sched_getaffinity(0))),
+        # Larger blocks and a higher level buy a noticeably smaller image, and with
+        # every core busy the extra CPU time hardly shows up on the clock.
+        "-b", "262144",
+        "-comp", "zstd", "-Xcompression-level", "8",
         "-wildcards",
         "-e", "boot/*"
     ])
 
-def write_script(filename, contents):
-    path = Path(filename)
-    path.write_text(contents)
-    path.chmod(0o755)
-
-
-def configure_initramfs(root_partuuid):
+def configure_initramfs(tar, state_partuuid):
     # We need our initramfs to do two things:
-    # * loopback-mount our squashfs
-    # * add an r/w overlayfs on top
+    # * mount our squashfs root partition
+    # * add an r/w overlayfs on top, backed by the state partition
     #
     # The second step is not very critical.
-    Path("image/etc/initramfs-tools/initramfs.conf").write_text("MODULES=list\nCOMPRESS=zstd\n")
+    # The initrd is rebuilt every time the kernel is installed, so favor speed over size
+    add_file(tar, "etc/initramfs-tools/initramfs.conf", "MODULES=list\nCOMPRESS=zstd\nCOMPRESSLEVEL=1\n")
 
     overlay_script =dd("""\
     #!/bin/sh -e
@@ -345,27 +549,67 @@ def configure_initramfs(root_partuuid):
     cd /run/overlay
 
     mkdir host immutable-root
-    mount /dev/disk/by-partuuid/""" + root_partuuid + """ host
+    mount /dev/disk/by-partuuid/""" + state_partuuid + """ host
     mount -o move /root immutable-root
     mkdir -p host/state host/work
     mount -t overlay -o lowerdir=immutable-root,upperdir=host/state,workdir=host/work none /root
     """)
-    write_script("image/usr/share/initramfs-tools/scripts/init-bottom/overlay", overlay_script)
-    write_script("image/usr/share/initramfs-tools/hooks/copy-modules", MODULES_HOOK)
+    add_file(tar, "usr/share/initramfs-tools/scripts/init-bottom/overlay", overlay_script, 0o755)
+    add_file(tar, "usr/share/initramfs-tools/hooks/copy-modules", MODULES_HOOK, 0o755)
 
     # No need for microcode in a cloud guest
     Path("image/usr/share/initramfs-tools/hooks/intel_microcode").unlink()
 
 
+def bootstrap(mkosi_args, image, cache):
+    """Produce a freshly bootstrapped tree in image, via mkosi or from the cache.
+
+    The cache is keyed on the exact mkosi invocation, so changing the package list
+    (or anything else about it) results in a fresh bootstrap. It's also keyed on the
+    ISO week: the tree's apt lists are frozen when it is archived, and the kernel is
+    installed against them, so a tree has to be rebuilt before the archive moves on
+    from the packages it names. Trees from earlier weeks are removed."""
+    week = time.strftime("%G-W%V", time.gmtime())
+    key = hashlib.sha256("\0".join(mkosi_args).encode("utf-8")).hexdigest()
+    cached = f"{cache}/{week}/{key}/image.tar.zst"
+    tar = ["tar", "--use-compress-program=zstd -T0", "--numeric-owner", "--xattrs", "--acls"]
+
+    if exists(cached):
+        if exists(image):
+            rmtree(image)
+        os.makedirs(image)
+        run([*tar, "--xattrs-include=*", "-x", "-f", cached, "-C", image])
+        return
+
+    run(mkosi_args)
+    os.makedirs(f"{cache}/{week}/{key}", exist_ok=True)
+    run([*tar, "-c", "-f", f"{cached}.tmp", "-C", image, "."])
+    os.replace(f"{cached}.tmp", cached)
+
+    with os.scandir(cache) as entries:
+        for entry in entries:
+            if entry.name != week:
+                rmtree(entry.path)
+
+
 def main():
     root_partuuid = str(uuid.uuid4())
+    state_partuuid = str(uuid.uuid4())
     esp_uuid = str(uuid.uuid4())
-    outfile = "image.raw"
-    squashfs_image = "image.squashfs"
+    # Everything else is scratch space, so the product lands outside of mkosi.output
+    outfile = abspath("image.raw.zst")
 
-    run([
+    # --force only discards the previous output. The package cache holds on to
+    # downloaded .debs, so a fresh bootstrap skips most of the network traffic.
+    # There's no --incremental: mkosi never regenerates those cache images when the
+    # package list changes, so it could quietly build from a stale tree.
+    apt_cache = abspath("mkosi.cache")
+    os.makedirs(apt_cache, exist_ok=True)
+
+    mkosi_args = [
         "bin/mkosi",
         "--force",
+        "--cache", apt_cache,
         "--repositories", "main,universe",
         "--with-docs",
         "-d", "ubuntu",
@@ -389,20 +633,37 @@ def main():
         # We don't want it. We need to install it now so that we can disable it.
         "-p intel-microcode",
         "--debug", "run",
-    ])
-    os.chdir("mkosi.output/ubuntu~jammy")
-    change_passwords("image")
-    configure_initramfs(root_partuuid)
-    customize_image()
-    os.rename("image/etc/resolv.conf", "image/etc/resolv.conf.bak")
-    extract_kernel()
-    os.rename("image/etc/resolv.conf.bak", "image/etc/resolv.conf")
-
-    make_squashfs(squashfs_image)
-
-    format_disk(esp_uuid, root_partuuid, outfile)
-    set_up_boot(outfile, root_partuuid, esp_uuid)
-    compress_product(outfile)
+    ]
+    # The image tree, boot/ and the esp/ staging tree live in RAM (the raw image goes
+    # to /dev/shm on its own). That spares the builder's disk (and its journal) a lot
+    # of small-file churn, and mksquashfs reads its input straight out of memory.
+    # Warm builds come from the bootstrap cache on disk, so nothing needs to outlive
+    # the build.
+    with tmpfs("mkosi.output", "8G"):
+        bootstrap(mkosi_args, "mkosi.output/ubuntu~jammy/image", abspath("cache"))
+        os.chdir("mkosi.output/ubuntu~jammy")
+        with overlay("image") as tar:
+            change_passwords(tar, "image")
+            configure_initramfs(tar, state_partuuid)
+            customize_image(tar)
+        os.rename("image/etc/resolv.conf", "image/etc/resolv.conf.bak")
+        extract_kernel(apt_cache)
+        os.rename("image/etc/resolv.conf.bak", "image/etc/resolv.conf")
+
+        # The raw image only exists to be compressed, so keep it off the disk entirely
+        with TemporaryDirectory(dir="/dev/shm") as scratch, ThreadPoolExecutor() as pool:
+            # mksquashfs creates the raw image, so nothing else gets written there
+            # until it's done. The EFI binary can be built meanwhile.
+            raw_image = f"{scratch}/image.raw"
+            squashfs = pool.submit(make_squashfs, raw_image)
+            build_efi(root_partuuid)
+
+            squashfs.result()
+            root_sectors = root_partition_sectors(raw_image)
+            set_up_boot(raw_image)
+            format_disk(esp_uuid, root_partuuid, state_partuuid, root_sectors, raw_image)
+            set_up_state(raw_image, root_sectors)
+            compress_product(raw_image, outfile)
 
 
 if __name__ == '__main__':